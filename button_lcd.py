@@ -23,6 +23,7 @@ if __name__ == "__main__":
    import tcs3200
    import os
    import time
+   import Queue
    
    # specify the Pi host/port.  For the remote host name, use '' if on local machine
    pi = pigpio.pi('', 8888)
@@ -53,19 +54,25 @@ if __name__ == "__main__":
 	     lcd.clear()
 	     lcd.message("TCS3200 ready...\nPress to start")
 	     _display_menu = False # Display menu only once in the loop
-      
-      if(GPIO.input(1) == GPIO.LOW):
+
+      # Wait for a button press
+      try:
+         button = tcs3200.button_presses.get(True, 1)
+      except Queue.Empty:
+         continue
+
+      if button == 1:
 	     _led_on()
 	     _calibrate_lcd()
 	     _led_off()
 	     _display_menu = True
-      elif(GPIO.input(7) == GPIO.LOW):
+      elif button == 7:
 	     _led_on()
 	     _reading_lcd()
 	     _csv_output_lcd(_file_output)
 	     _led_off()
 	     _display_menu = True
-      elif(GPIO.input(8) == GPIO.LOW):
+      elif button == 8:
 	     _led_off()
 	     capture.cancel()
 	     lcd.clear()
@@ -75,3 +82,6 @@ if __name__ == "__main__":
 	     pi.stop()
 	     GPIO.cleanup()            
 	     quit()
+
+      # Ignore the buttons pressed while busy
+      tcs3200._clear_button_presses()
@@ -17,11 +17,9 @@ from __future__ import print_function
 
 if __name__ == "__main__":
 
-   import sys
    import pigpio
    import time
    import tcs3200
-   import os
    from blessings import Terminal
    term = Terminal()
 
@@ -95,6 +93,6 @@ if __name__ == "__main__":
 	   
 	   else:
 	        print("Invalid choice, please try again...")
-	        os.execv(__file__, sys.argv)
+	        continue
   
    print (term.normal)
@@ -9,30 +9,99 @@
 # Script that allows to run pigpiod as a Linux service with root privileges : https://github.com/joan2937/pigpio/tree/master/util
 #
 # Before starting the script pigpiod must be running and the Pi host/port must be specified.
+# pigpiod must run on the same Pi as the script, OUT edges are read from its /dev/pigpio notification pipes.
 #
 # sudo pigpiod (or use a startup script)
 # export PIGPIO_ADDR=hostame (or use the pigpio.pi() function)
 # export PIGPIO_PORT=port (or use the pigpio.pi() function)
 
-from __future__ import print_function
-
-from blessings import Terminal
-term = Terminal()
+from __future__ import print_function, division
 
 import pigpio
 import time
 import threading
-import csv
+import os
+import io
+import array
+import Queue
+from itertools import izip
+
+_tickDiff = pigpio.tickDiff
+
+# Terminal for the stdout functions, blessings is only imported when one of them runs
+_term = None
+
+def _terminal():
+   global _term
+   if _term is None:
+      from blessings import Terminal
+      _term = Terminal()
+   return _term
+
+# Clock used to schedule the readings, time.monotonic is not available before Python 3.3
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Weight of the latest reading in the smoothed hertz used to tune the sample times
+HZ_SMOOTHING = 0.3
+
+# Set the sample time of each colour (delays, updated in place) to get samples pulses
+# The hertz just read are smoothed into hz_avg (updated in place) so that one noisy reading
+# does not swing the sample time between its limits
+def _tune_delays(hertz, delays, hz_avg, samples):
+   for c in range(3):
+
+      hz = hertz[c]
+      if hz:
+         if hz_avg[c]:
+            hz = hz_avg[c] = hz_avg[c] + HZ_SMOOTHING * (hz - hz_avg[c])
+         else: # First edges, start the average from this reading.
+            hz_avg[c] = hz
+         # Calculate dly needed to get samples pulses.
+         dly = samples / hz
+      else: # Didn't find any edges, increase sample time.
+         hz_avg[c] = 0
+         dly = delays[c] + 0.1
+
+      # Constrain dly to reasonable values.
+      delays[c] = 0.001 if dly < 0.001 else 0.5 if dly > 0.5 else dly
+
+# Only one sensor sweeps its colour filters at a time (see sensor._sweep)
+_sweep_lock = threading.Lock()
+
+# Get the bank masks (set, clear) writing each (gpio, level) pair, gpios 0-31 only
+def _bank_masks(*pairs):
+   set_mask = 0
+   clear_mask = 0
+   for gpio, level in pairs:
+      if level:
+         set_mask |= 1 << gpio
+      else:
+         clear_mask |= 1 << gpio
+   return set_mask, clear_mask
 
 # Buttons
 import RPi.GPIO as GPIO
 
+# Button presses (BCM pin numbers), queued by the GPIO edge detection thread
+button_presses = Queue.Queue()
+
+def _button_pressed(channel):
+  button_presses.put(channel)
+
+# Forget the buttons pressed so far
+def _clear_button_presses():
+  while not button_presses.empty():
+    button_presses.get_nowait()
+
 # Setup GPIO for buttons
 def _setup_buttons():
   GPIO.setmode(GPIO.BCM)
   GPIO.setup(1, GPIO.IN, pull_up_down=GPIO.PUD_UP) # If using the pull-up resistor, no external resistor is needed and the switch should be connected between GPIO pin and ground
   GPIO.setup(7, GPIO.IN, pull_up_down=GPIO.PUD_UP)
   GPIO.setup(8, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+  # A press pulls the pin low, the kernel detects the falling edge so the buttons are not polled
+  for pin in (1, 7, 8):
+    GPIO.add_event_detect(pin, GPIO.FALLING, callback=_button_pressed, bouncetime=300)
 
 # Import LCD module
 import Adafruit_CharLCD as LCD
@@ -54,6 +123,18 @@ lcd_rows    = 2
 lcd = LCD.Adafruit_CharLCD(lcd_rs, lcd_en, lcd_d4, lcd_d5, lcd_d6, lcd_d7,
                         lcd_columns, lcd_rows, lcd_backlight)
 
+# LCD messages with the three colour values
+LCD_BLACK_HZ = "BLACK RGB (Hz)\n{:.0f} {:.0f} {:.0f}"
+LCD_WHITE_HZ = "WHITE RGB (Hz)\n{:.0f} {:.0f} {:.0f}"
+LCD_STORED = "Datas stored\n{:.0f} {:.0f} {:.0f}"
+
+# The CSV file is kept open between readings, it is flushed when no more rows are waiting
+# to be written or every CSV_FLUSH_ROWS rows. Waiting rows are written in batches of up to CSV_FLUSH_ROWS.
+CSV_FLUSH_ROWS = 32
+
+# CSV row: timestamp, RGB, hertz and cycles, tab separated with the csv module line terminator
+CSV_ROW = "%.3f\t%.2f\t%.2f\t%.2f\t%.1f\t%.1f\t%.1f\t%d\t%d\t%d\r\n"
+
 """
 This class reads RGB values from a TCS3200 colour sensor.
 
@@ -99,16 +180,12 @@ class sensor(threading.Thread):
       self._OUT = OUT
       self._S2 = S2
       self._S3 = S3
+      self._filter_bank = [self._filter_masks(f) for f in range(4)] # Bank masks of each colour.
 
       self._mode_OUT = pi.get_mode(OUT)
       self._mode_S2 = pi.get_mode(S2)
       self._mode_S3 = pi.get_mode(S3)
 
-      """
-      Disable frequency output (OUT).
-      """
-      pi.write(OUT, 0)
-      
       """
       Disable colour filter selection (S2 S3).
       """     
@@ -131,10 +208,18 @@ class sensor(threading.Thread):
       if OE is not None:
          self._mode_OE = pi.get_mode(OE)
          pi.set_mode(OE, pigpio.OUTPUT)
+
+      if OE is None:
+         """
+         Disable frequency output (OUT).
+         """
+         pi.write(OUT, 0)
+      else:
          """
-         Enable device (active low).
+         OE gates the frequency output, OUT stays an input for good, pulled down while no sensor drives it.
          """
-         pi.write(OE, 0)
+         pi.set_mode(OUT, pigpio.INPUT)
+         pi.set_pull_up_down(OUT, pigpio.PUD_DOWN)
 
       self.set_sample_size(20)
 
@@ -143,34 +228,93 @@ class sensor(threading.Thread):
       """
       self.set_update_interval(1.0)
 
+      """
+      The initial levels of S2/S3, S0/S1 and OE are written together, one set_bank_1 and one clear_bank_1 call.
+
+      S2/S3 Clear (no colour filter).
+      """
+      set_mask, clear_mask = self._filter_bank[3] # Clear.
+
       """
       S0/S1 2% Frequency scale selection.
             The higher the frequency the faster the response. If you go from setting 1 (2%) to setting 2 (20%) the readings may be faster.
             if (self._S0 is not None) and (self._S1 is not None)
       """
-      self.set_frequency(3)
+      if (S0 is not None) and (S1 is not None):
+         self._frequency = 3
+         set_mask |= (1 << S0) | (1 << S1) # 100%
+      else:
+         self._frequency = None
 
       """
-      S2/S3 Clear (no colour filter).
+      Disable device (active low), it is only enabled while sampling so that sensors can share OUT.
       """
-      self._set_filter(3) # Clear.
+      if OE is not None:
+         set_mask |= 1 << OE
+
+      self._write_bank((set_mask, clear_mask))
 
       self._rgb_black = [0]*3
       self._rgb_white = [10000]*3
+      self._rgb_black_tuple = tuple(self._rgb_black) # Returned by get_black_level.
+      self._rgb_white_tuple = tuple(self._rgb_white) # Returned by get_white_level.
+      self._rgb_scale = [0]*3 # 255 / (white Hz - black Hz).
+      self._set_rgb_scale()
 
       self.hertz=[0]*3 # Latest triplet.
+      self._hertz_tuple=(0, 0, 0) # Latest triplet, returned by get_hertz.
       self._hertz=[0]*3 # Current values.
 
       self.tally=[1]*3 # Latest triplet.
       self._tally=[1]*3 # Current values.
 
       self._delay=[0.1]*3 # Tune delay to get _samples pulses.
+      self._hz_avg=[0]*3 # Smoothed hertz used to tune the delays.
 
       self._cycle = 0
+      self._start_tick = 0
+      self._last_tick = 0
+      self._sample_tick = 0 # Tick of the last filter transition.
+      self._sweeping = False # S2/S3 transitions are from this sensor.
+      self._transition_tick = 0 # Tick of the last S2/S3 transition accepted.
+      self._sweep_done = threading.Event() # Set by the Green -> Clear callback.
+      self._cancelled = threading.Event() # Set by cancel.
+
+      self._csv_file = None # CSV output, opened on the first write.
+      self._csv_path = None
+      self._csv_rows = 0 # Rows written since the last flush.
 
-      self._cb_OUT = pi.callback(OUT, pigpio.RISING_EDGE, self._cbf)
-      self._cb_S2 = pi.callback(S2, pigpio.EITHER_EDGE, self._cbf)
-      self._cb_S3 = pi.callback(S3, pigpio.EITHER_EDGE, self._cbf)
+      """
+      Rows are written to the CSV file by a background thread.
+      """
+      self._csv_queue = Queue.Queue()
+      self._csv_thread = threading.Thread(target=self._csv_writer)
+      self._csv_thread.daemon = True
+      self._csv_thread.start()
+
+      """
+      64K buffer for the CSV file, large appends suit the SD card best.
+      """
+      self.set_csv_buffer_size(65536)
+
+      """
+      OUT edges are not dispatched one by one to Python, pigpiod queues them in a notification pipe
+      which is read in bulk at each filter transition.
+      """
+      self._mask_OUT = 1 << OUT
+      self._notify_buf = bytearray(12 * 16384) # Whole 12 byte records, read in place.
+      self._notify_view = memoryview(self._notify_buf)
+      self._notify_len = 0
+      self._notify = pi.notify_open()
+      self._notify_file = io.FileIO(
+         os.open('/dev/pigpio%d' % self._notify, os.O_RDONLY | os.O_NONBLOCK), 'r')
+      pi.notify_begin(self._notify, self._mask_OUT)
+
+      self._cbs = [
+         pi.callback(S2, pigpio.FALLING_EDGE, self._cbf_start),
+         pi.callback(S3, pigpio.RISING_EDGE, self._cbf_red),
+         pi.callback(S2, pigpio.RISING_EDGE, self._cbf_blue),
+         pi.callback(S3, pigpio.FALLING_EDGE, self._cbf_green)]
 
       self.daemon = True
 
@@ -180,9 +324,16 @@ class sensor(threading.Thread):
       """
       Cancel the sensor and release resources.
       """
-      self._cb_S3.cancel()
-      self._cb_S2.cancel()
-      self._cb_OUT.cancel()
+      self._cancelled.set()
+      self.join(3.0) # Let the current sweep end.
+
+      for cb in self._cbs:
+         cb.cancel()
+
+      self._pi.notify_close(self._notify)
+      self._notify_file.close()
+
+      self._csv_close()
 
       self.set_frequency(0) # off
 
@@ -198,6 +349,7 @@ class sensor(threading.Thread):
 
       if self._OE is not None:
          self._pi.write(self._OE, 1) # disable device
+         self._pi.set_pull_up_down(self._OUT, pigpio.PUD_OFF)
          self._pi.set_mode(self._OE, self._mode_OE)
 
    def get_rgb(self, top=255):
@@ -208,50 +360,69 @@ class sensor(threading.Thread):
       RGB = 255 * (Sample Hz - calibrated black Hz) / (calibrated white Hz - calibrated black Hz)
 
       By default the RGB values are constrained to be between 0 and 255. A different upper limit can be set by using the top parameter.
+
+      The division by the calibrated range is precomputed when the black or white level is set.
       """
-      rgb = [0]*3
-      for c in range(3):
-         v = self.hertz[c] - self._rgb_black[c]
-         s = self._rgb_white[c] - self._rgb_black[c]
-         p = top * v / s
-         if p < 0:
-            p = 0
-         elif p > top:
-            p = top
-         rgb[c] = p
-      return rgb[:]
+      # The three colours are computed side by side, without a loop.
+      r, g, b = self._hertz_tuple
+      black_r, black_g, black_b = self._rgb_black
+      scale_r, scale_g, scale_b = self._rgb_scale
+      if top != 255:
+         k = top / 255
+         scale_r *= k; scale_g *= k; scale_b *= k
+      r = (r - black_r) * scale_r
+      g = (g - black_g) * scale_g
+      b = (b - black_b) * scale_b
+      return [0 if r < 0 else top if r > top else r,
+              0 if g < 0 else top if g > top else g,
+              0 if b < 0 else top if b > top else b]
 
    """
    Get the latest hertz reading.
+   The tuple is only rebuilt when a new reading is complete.
    """
    def get_hertz(self):
-      return self.hertz[:]
+      return self._hertz_tuple
  
    """
    Set the black level calibration.
    """
    def set_black_level(self, rgb):
-      for i in range(3):
-         self._rgb_black[i] = rgb[i]
+      self._rgb_black[:] = rgb[:3]
+      self._rgb_black_tuple = tuple(self._rgb_black)
+      self._set_rgb_scale()
 
    """
    Get the black level calibration.
    """
    def get_black_level(self):
-      return self._rgb_black[:]
+      return self._rgb_black_tuple
 
    """
    Set the white level calibration.  
    """
    def set_white_level(self, rgb):
-      for i in range(3):
-         self._rgb_white[i] = rgb[i]
+      self._rgb_white[:] = rgb[:3]
+      self._rgb_white_tuple = tuple(self._rgb_white)
+      self._set_rgb_scale()
 
    """
    Get the white level calibration.
    """
    def get_white_level(self):
-      return self._rgb_white[:]
+      return self._rgb_white_tuple
+
+   """
+   Precompute the RGB scale factors from the black and white levels.
+   A colour with the same black and white level gets a zero scale instead of dividing by zero.
+   """
+   def _set_rgb_scale(self):
+      for c in range(3):
+         s = self._rgb_white[c] - self._rgb_black[c]
+         if s:
+            self._rgb_scale[c] = 255 / s
+         else:
+            self._rgb_scale[c] = 0.0
  
    """
    Set the frequency scaling.
@@ -275,8 +446,7 @@ class sensor(threading.Thread):
 
       if (self._S0 is not None) and (self._S1 is not None):
          self._frequency = f
-         self._pi.write(self._S0, S0) # BCM 4, valeur de S0 en fonction de f
-         self._pi.write(self._S1, S1) # BCM 17, valeur de S1 en fonction de f
+         self._write_bank(_bank_masks((self._S0, S0), (self._S1, S1))) # BCM 4 et BCM 17, valeurs de S0 et S1 en fonction de f
       else:
          self._frequency = None
 
@@ -316,6 +486,26 @@ class sensor(threading.Thread):
    def get_sample_size(self):
       return self._samples
 
+   """
+   Set the CSV file buffer size in bytes.
+
+   8K, 16K or 64K suit most SD cards. Unbuffered (0) or tiny buffers turn every
+   row into several small writes to the card and are much slower, so the size
+   is constrained to at least 512 bytes. The file is reopened on the next write.
+   """
+   def set_csv_buffer_size(self, n):
+      if n < 512:
+         n = 512
+
+      self._csv_buffer_size = n
+      self._csv_close()
+
+   """
+   Get the CSV file buffer size in bytes.
+   """
+   def get_csv_buffer_size(self):
+      return self._csv_buffer_size
+
    """
    Pause reading (until a call to resume).
    """
@@ -329,7 +519,7 @@ class sensor(threading.Thread):
       self._read = True
 
    """
-   Set the colour to be sampled.
+   Get the bank masks of the S2/S3 gpios to set and to clear to select a colour.
    
    f  S2  S3  Photodiode
    0  L   L   Red
@@ -337,7 +527,7 @@ class sensor(threading.Thread):
    2  L   H   Blue
    3  H   L   Clear (no filter)
    """
-   def _set_filter(self, f):
+   def _filter_masks(self, f):
 
       if f == 0: # Red
          S2 = 0; S3 = 0
@@ -347,113 +537,253 @@ class sensor(threading.Thread):
          S2 = 0; S3 = 1
       else: # Clear
          S2 = 1; S3 = 0
-				
-      self._pi.write(self._S2, S2); self._pi.write(self._S3, S3)
 
-   def _cbf(self, g, l, t):
+      return _bank_masks((self._S2, S2), (self._S3, S3))
 
-      if g == self._OUT: # Frequency counter.
-         if self._cycle == 0:
-            self._start_tick = t
-         else:
-            self._last_tick = t
-         self._cycle += 1
-
-      else: # Must be transition between colour samples.
-         if g == self._S2:
-            if l == 0: # Clear -> Red.
-               self._cycle = 0
-               return
-            else:      # Blue -> Green.
-               colour = 2
-         else:
-            if l == 0: # Green -> Clear.
-               colour = 1
-            else:      # Red -> Blue.
-               colour = 0
-
-         if self._cycle > 1:
-            self._cycle -= 1
-            td = pigpio.tickDiff(self._start_tick, self._last_tick)
-            self._hertz[colour] = (1000000 * self._cycle) / td
-            self._tally[colour] = self._cycle
+   """
+   Set the colour to be sampled, the masks of each colour are precomputed (see _filter_masks).
+   """
+   def _set_filter(self, f):
+      self._write_bank(self._filter_bank[f])
+
+   """
+   Write gpios with the bank masks (set, clear), a bank call with an empty mask is skipped.
+   """
+   def _write_bank(self, masks):
+      set_mask, clear_mask = masks
+      if set_mask:
+         self._pi.set_bank_1(set_mask)
+      if clear_mask:
+         self._pi.clear_bank_1(clear_mask)
+
+   """
+   Get a wave pulse selecting colour f for t seconds, on and off are masks of other gpios to set and clear.
+   """
+   def _filter_pulse(self, f, t, on=0, off=0):
+      set_mask, clear_mask = self._filter_bank[f]
+      return pigpio.pulse(set_mask | on, clear_mask | off, int(t * 1000000))
+
+   """
+   Count the OUT rising edges queued in the notification pipe between the start of the current
+   colour sample and tick t. Edges from tick t onwards are kept for the next colour sample.
+
+   Each notification is 12 bytes: sequence number, flags, tick and the levels of gpios 0-31.
+   All the notifications read are decoded at once as 32 bit words: seqno | flags << 16, tick, levels.
+   """
+   def _count_edges(self, t):
+
+      # Append to the records left by the previous call, None means the pipe is empty.
+      n = self._notify_len
+      got = self._notify_file.readinto(self._notify_view[n:])
+      if got:
+         n += got
+
+      # The loop runs once per edge, it only uses locals.
+      mask_OUT = self._mask_OUT
+      sample_tick = self._sample_tick
+      cycle = self._cycle
+      start_tick = self._start_tick
+      last_tick = self._last_tick
+
+      words = array.array('I')
+      words.fromstring(buffer(self._notify_buf, 0, n - (n % 12)))
+      i = 0
+      for flags, tick, level in izip(words[0::3], words[1::3], words[2::3]):
+         if ((tick - t) & 0xFFFFFFFF) < 0x80000000:
+            break # Next colour sample.
+         i += 12
+         if (flags >> 16) or not (level & mask_OUT):
+            continue # Keep alive, watchdog or falling edge.
+         if ((tick - sample_tick) & 0xFFFFFFFF) >= 0x80000000:
+            continue # Before the start of the colour sample.
+         if cycle == 0:
+            start_tick = tick
          else:
-            self._hertz[colour] = 0
-            self._tally[colour] = 0
+            last_tick = tick
+         cycle += 1
 
-         self._cycle = 0
+      # Move the unread bytes to the start of the buffer.
+      if i:
+         self._notify_view[:n - i] = self._notify_view[i:n]
+      self._notify_len = n - i
+      self._cycle = cycle
+      self._start_tick = start_tick
+      self._last_tick = last_tick
 
-         # Have we a new set of RGB?
-         if colour == 1:
-            for i in range(3):
-               self.hertz[i] = self._hertz[i]
-               self.tally[i] = self._tally[i]
+   """
+   Callbacks on the S2/S3 transitions between colour samples, one per transition of the
+   Red -> Blue -> Green -> Clear sweep so no callback has to find out which transition it is.
+   """
+   def _cbf_start(self, g, l, t): # Clear -> Red.
+      if not self._transition(t):
+         return
+      self._sample_tick = t
+      self._count_edges(t) # Discard edges seen before Red.
+      self._cycle = 0
 
-   def run(self):
+   def _cbf_red(self, g, l, t): # Red -> Blue.
+      if self._transition(t):
+         self._end_sample(0, t)
 
-      self._read = True
-      while True:
-         if self._read:
+   def _cbf_blue(self, g, l, t): # Blue -> Green.
+      if self._transition(t):
+         self._end_sample(2, t)
 
-            next_time = time.time() + self._interval
+   def _cbf_green(self, g, l, t): # Green -> Clear.
+      if not self._transition(t):
+         return
+      self._end_sample(1, t)
 
-            self._pi.set_mode(self._OUT, pigpio.INPUT) # Enable output gpio.
+      # We have a new set of RGB, publish it by swapping the current and latest lists.
+      # The next sweep overwrites the old latest lists, take a copy of self.hertz or self.tally to keep them.
+      self.hertz, self._hertz = self._hertz, self.hertz
+      self.tally, self._tally = self._tally, self.tally
+      hertz = self.hertz
+      self._hertz_tuple = (hertz[0], hertz[1], hertz[2])
 
-            """
-            The order Red -> Blue -> Green -> Clear is needed by the callback function so that each S2/S3 transition triggers state change.
-            The order was chosen so that a single gpio changes state between each colour to be sampled.
-            """
-            self._set_filter(0) # Red
-            time.sleep(self._delay[0])
+      self._sweep_done.set()
 
-            self._set_filter(2) # Blue
-            time.sleep(self._delay[2])
+   """
+   Check that an S2/S3 edge at tick t is a transition of this sensor's sweep.
+   The filters change every millisecond at most, edges closer than 50 us to the previous
+   transition are noise on the S2/S3 lines. The tick is recorded before any work is done.
+   """
+   def _transition(self, t):
+      if not self._sweeping:
+         return False # Another sensor sharing S2/S3.
+      if ((t - self._transition_tick) & 0xFFFFFFFF) < 50:
+         return False
+      self._transition_tick = t
+      return True
+
+   """
+   Convert the edges counted until tick t into the frequency of a colour.
+   """
+   def _end_sample(self, colour, t):
 
-            self._set_filter(1) # Green
-            time.sleep(self._delay[1])
+      self._count_edges(t)
 
-            self._pi.write(self._OUT, 0) # Disable output gpio.
+      cycle = self._cycle - 1 # Periods between the first and last rising edges.
+      if cycle > 0:
+         td = _tickDiff(self._start_tick, self._last_tick)
+         self._hertz[colour] = (1000000 * cycle) / td
+         self._tally[colour] = cycle
+      else:
+         self._hertz[colour] = 0
+         self._tally[colour] = 0
 
-            self._set_filter(3) # Clear
+      self._cycle = 0
+      self._sample_tick = t
 
-            delay = next_time - time.time()
+   """
+   Sample the three colours once.
 
-            if delay > 0.0:
-               time.sleep(delay)
+   Several sensors can share the OUT (and S0-S3) lines if each one has its own OE gpio. pigpiod
+   transmits a single wave at a time, so the sweeps of all the sensors are serialized, and the
+   OE of a sensor is only enabled during its own sweep.
+   """
+   def _sweep(self):
 
-            # Tune the next set of delays to get reasonable results as quickly as possible.
+      pi = self._pi
+      OUT = self._OUT
+      OE = self._OE
+      mask_OE = 0 if OE is None else 1 << OE
+      delays = self._delay
+      filter_pulse = self._filter_pulse
+      sleep = time.sleep
 
-            for c in range(3):
+      with _sweep_lock:
 
-               # Calculate dly needed to get _samples pulses.
+         self._sweep_done.clear()
+         self._sweeping = True
 
-               if self.hertz[c]:
-                  dly = self._samples / float(self.hertz[c])
-               else: # Didn't find any edges, increase sample time.
-                  dly = self._delay[c] + 0.1
+         if OE is None:
+            pi.set_mode(OUT, pigpio.INPUT) # Enable output gpio.
 
-               # Constrain dly to reasonable values.
+         """
+         The order Red -> Blue -> Green -> Clear is needed by the callback function so that each S2/S3 transition triggers state change.
+         The order was chosen so that a single gpio changes state between each colour to be sampled.
+
+         The filters are switched by a pigpio wave, pigpiod times each colour sample instead of Python sleeps.
+         OE is switched by the same wave, so the device is disabled as soon as the Green sample ends.
+         """
+         pi.wave_add_generic([
+            filter_pulse(0, delays[0], off=mask_OE), # Red, enable device (active low).
+            filter_pulse(2, delays[2]), # Blue
+            filter_pulse(1, delays[1]), # Green
+            filter_pulse(3, 0, on=mask_OE)]) # Clear, disable device.
+         wid = pi.wave_create()
+         pi.wave_send_once(wid)
+
+         # Sleep for the length of the wave, then check the end of the transmission.
+         sleep(delays[0] + delays[2] + delays[1])
+         while pi.wave_tx_busy():
+            sleep(0.001)
 
-               if dly < 0.001:
-                  dly = 0.001
-               elif dly > 0.5:
-                  dly = 0.5
+         pi.wave_delete(wid)
+
+         if OE is None:
+            pi.write(OUT, 0) # Disable output gpio.
+
+         # The callbacks must see the end of this sweep before another sensor moves S2/S3.
+         self._sweep_done.wait(0.5)
+         self._sweeping = False
+
+   def run(self):
 
-               self._delay[c] = dly
+      # Bound once, self.hertz is not: it is swapped at the end of each sweep.
+      delays = self._delay
+      hz_avg = self._hz_avg
+      sweep = self._sweep
+      cancelled = self._cancelled.is_set
+      wait = self._cancelled.wait
+      monotonic = _monotonic
+      tune_delays = _tune_delays
+
+      self._read = True
+      next_time = monotonic()
+      while not cancelled():
+         if self._read:
+
+            next_time += self._interval
+
+            sweep()
+
+            delay = next_time - monotonic()
+
+            if delay > 0.0:
+               if wait(delay):
+                  break
+            else:
+               next_time -= delay # Late (or resumed), restart the schedule from now.
+
+            # Tune the next set of delays to get reasonable results as quickly as possible.
+            tune_delays(self.hertz, delays, hz_avg, self._samples)
 
          else:
-            time.sleep(0.1)
+            wait(0.1)
+
+   # Wait until the _monotonic() time t, return True if the sensor was cancelled meanwhile
+   def _wait_until(self, t):
+      delay = t - _monotonic()
+      if delay > 0.0:
+         return self._cancelled.wait(delay)
+      return self._cancelled.is_set()
 
    # Calibration get black and white level (hz) (stdout)
    def _calibrate(self):
       
       # stdout
+      term = _terminal()
       print (term.bold('\n> BLACK calibration'))    
       
       raw_input('Place a black object in front of the sensor\nthen press ENTER to start.\n')
                 
+      next_time = _monotonic()
       for i in range(5):
-         time.sleep(self._interval)
+         next_time += self._interval
+         if self._wait_until(next_time):
+            return
          hz = self.get_hertz()
          print (hz)
       self.set_black_level(hz)
@@ -466,8 +796,11 @@ class sensor(threading.Thread):
       print (term.bold('\n> WHITE calibration'))    
       raw_input('Place a white object in front of the sensor\nthen press ENTER to start.\n')    
 
+      next_time = _monotonic()
       for i in range(5):
-         time.sleep(self._interval)
+         next_time += self._interval
+         if self._wait_until(next_time):
+            return
          hz = self.get_hertz()
          print(hz)
       self.set_white_level(hz)
@@ -484,15 +817,18 @@ class sensor(threading.Thread):
 
       # LCD display for black     
       lcd.clear()
-      lcd.message("BLACK calibration\nPlace black object")     
-      time.sleep(5)     
+      lcd.message("Place black obj\nPress to start")
+      self._wait_button(1)
       lcd.clear()
       lcd.blink(True)
       lcd.message('BLACK:Progress ')
 
       # Get black level           
+      next_time = _monotonic()
       for i in range(5):
-         time.sleep(self._interval)
+         next_time += self._interval
+         if self._wait_until(next_time):
+            return
          hz = self.get_hertz()
          print (hz)
       self.set_black_level(hz)
@@ -501,20 +837,23 @@ class sensor(threading.Thread):
       self.rhz, self.ghz, self.bhz = self.get_hertz()
       lcd.clear()
       lcd.blink(False)
-      lcd.message("BLACK RGB (Hz)\n" + str(self.rhz) + " " + str(self.ghz) + " " + str(self.bhz))
+      lcd.message(LCD_BLACK_HZ.format(self.rhz, self.ghz, self.bhz))
       time.sleep(5)
 
       # LCD display for white
       lcd.clear()
-      lcd.message("WHITE calibration\nPlace white object")
-      time.sleep(5)
+      lcd.message("Place white obj\nPress to start")
+      self._wait_button(1)
       lcd.clear()
       lcd.blink(True)
       lcd.message('WHITE:Progress ')      
 
       # Get white level
+      next_time = _monotonic()
       for i in range(5):
-         time.sleep(self._interval)
+         next_time += self._interval
+         if self._wait_until(next_time):
+            return
          hz = self.get_hertz()
          print(hz)
       self.set_white_level(hz)
@@ -523,7 +862,7 @@ class sensor(threading.Thread):
       self.rhz, self.ghz, self.bhz = self.get_hertz()     
       lcd.clear()
       lcd.blink(False)
-      lcd.message("WHITE RGB (Hz)\n" + str(self.rhz) + " " + str(self.ghz) + " " + str(self.bhz))
+      lcd.message(LCD_WHITE_HZ.format(self.rhz, self.ghz, self.bhz))
       time.sleep(3)
       
       # Display end of calibration message
@@ -531,9 +870,27 @@ class sensor(threading.Thread):
       lcd.message("Calibration OK")
       time.sleep(3)
 
+   # Wait for a press on the button connected to pin, give up after timeout seconds
+   def _wait_button(self, pin, timeout=30):
+
+      _clear_button_presses()
+
+      # One clock read per press, the first wait is the whole timeout.
+      deadline = _monotonic() + timeout
+      delay = timeout
+      while delay > 0.0:
+         try:
+            if button_presses.get(True, delay) == pin:
+               return True
+         except Queue.Empty:
+            return False
+         delay = deadline - _monotonic() # Another button, wait for what is left.
+      return False
+
    # Reading (stdout)
    def _reading(self):
             
+      next_time = _monotonic()
       for i in range(5): # 5 readings
 	        """
 	        The first triplet is the RGB values.
@@ -546,7 +903,9 @@ class sensor(threading.Thread):
 	        self.rcy, self.gcy, self.bcy = self.tally
 
 	        print(self.r, self.g, self.b, self.rhz, self.ghz, self.bhz, self.rcy, self.gcy, self.bcy)
-	        time.sleep(self._interval)
+	        next_time += self._interval
+	        if self._wait_until(next_time):
+	           return
 
    # Reading (LCD)
    def _reading_lcd(self):
@@ -555,6 +914,7 @@ class sensor(threading.Thread):
       lcd.blink(True)
       lcd.message('READING... ')
             
+      next_time = _monotonic()
       for i in range(5): # 5 readings
 	        """
 	        The first triplet is the RGB values.
@@ -565,15 +925,61 @@ class sensor(threading.Thread):
 	        self.r, self.g, self.b = self.get_rgb()
 	        self.rhz, self.ghz, self.bhz = self.get_hertz()
 	        self.rcy, self.gcy, self.bcy = self.tally
-	        time.sleep(self._interval)	        
+	        next_time += self._interval
+	        if self._wait_until(next_time):
+	           return	        
+
+   # Queue a row (tuple) for the CSV file, the file is kept open between readings
+   # The file is opened here so that an error is reported to the caller
+   def _csv_write(self, _file_output, row):
+
+      if self._csv_path != _file_output:
+         self._csv_close()
+         self._csv_file = open(_file_output, 'ab', self._csv_buffer_size)
+         self._csv_path = _file_output
+
+      self._csv_queue.put(row)
+
+   # Background thread writing the queued rows into the CSV file
+   def _csv_writer(self):
+
+      queue = self._csv_queue
+      while True:
+         batch = [queue.get()]
+         # Take the rows already waiting too, they are written with a single call.
+         while len(batch) < CSV_FLUSH_ROWS:
+            try:
+               batch.append(queue.get_nowait())
+            except Queue.Empty:
+               break
+         try:
+            self._csv_file.write(''.join([CSV_ROW % row for row in batch]))
+            self._csv_rows += len(batch)
+            if queue.empty() or (self._csv_rows >= CSV_FLUSH_ROWS):
+               self._csv_file.flush()
+               self._csv_rows = 0
+         except (IOError, OSError):
+            print ("File error !")
+         finally:
+            for row in batch:
+               queue.task_done()
+
+   # Flush and close the CSV file, once the queued rows are written
+   def _csv_close(self):
+
+      self._csv_queue.join()
+
+      if self._csv_file is not None:
+         self._csv_file.close()
+         self._csv_file = None
+         self._csv_path = None
+         self._csv_rows = 0
 
    # Write the last reading into a CSV file, add a timestamp (stdout)
    def _csv_output(self, _file_output):
 
-      try:	   
-          with open(_file_output, 'a') as csvfile:
-             capturewriter = csv.writer(csvfile, delimiter='\t')
-             capturewriter.writerow([time.time()] + [self.r] + [self.g] + [self.b] + [self.rhz] + [self.ghz] + [self.bhz] + [self.rcy] + [self.gcy] + [self.bcy])
+      try:
+          self._csv_write(_file_output, (time.time(), self.r, self.g, self.b, self.rhz, self.ghz, self.bhz, self.rcy, self.gcy, self.bcy))
       except:
 		  print ("File error !")
       else:
@@ -583,10 +989,8 @@ class sensor(threading.Thread):
    # Write the last reading into a CSV file, add a timestamp (LCD)
    def _csv_output_lcd(self, _file_output):
       
-      try:	   
-          with open(_file_output, 'a') as csvfile:
-             capturewriter = csv.writer(csvfile, delimiter='\t')
-             capturewriter.writerow([time.time()] + [self.r] + [self.g] + [self.b] + [self.rhz] + [self.ghz] + [self.bhz] + [self.rcy] + [self.gcy] + [self.bcy])
+      try:
+          self._csv_write(_file_output, (time.time(), self.r, self.g, self.b, self.rhz, self.ghz, self.bhz, self.rcy, self.gcy, self.bcy))
       except:
 		  lcd.clear()
 		  lcd.message("File error !")
@@ -594,7 +998,7 @@ class sensor(threading.Thread):
       else:
 		  lcd.clear()
 		  lcd.blink(False)
-		  lcd.message("Datas stored\n" + str(self.r) + " " + str(self.g) + " " + str(self.b))
+		  lcd.message(LCD_STORED.format(self.r, self.g, self.b))
 		  time.sleep(5)
 
    # LED On